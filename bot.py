@@ -18,22 +18,26 @@ if not WEB_APP_URL:
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+# Клавиатура и текст не меняются за время жизни процесса — собираем их один раз
+_WELCOME_TEXT = "Добро пожаловать в калькулятор топлива!"
+_WELCOME_MARKUP = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="Нажмите на кнопку", web_app=WebAppInfo(url=WEB_APP_URL))]],
+    resize_keyboard=True
+)
+
 @dp.message(CommandStart())
 async def send_welcome(message: types.Message):
     """Отправляет приветственное сообщение с кнопкой Web App."""
-    web_app_info = WebAppInfo(url=WEB_APP_URL)
-    keyboard = [
-        [KeyboardButton(text="Нажмите на кнопку", web_app=web_app_info)]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
-    await message.answer(
-        "Добро пожаловать в калькулятор топлива!",
-        reply_markup=markup
-    )
+    await message.answer(_WELCOME_TEXT, reply_markup=_WELCOME_MARKUP)
 
 async def main() -> None:
+    # Необязательная задержка старта (например, чтобы дождаться веб-сервера); не блокирует event loop
+    start_delay = float(os.getenv("BOT_START_DELAY", "0"))
+    if start_delay > 0:
+        await asyncio.sleep(start_delay)
     print("Запуск бота...")
-    await dp.start_polling(bot)
+    # Длинный long-polling таймаут + только нужные типы апдейтов: меньше пустых getUpdates
+    await dp.start_polling(bot, polling_timeout=30, allowed_updates=["message"])
 
 if __name__ == "__main__":
     try:
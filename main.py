@@ -1,193 +1,458 @@
-import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from fastapi import FastAPI, HTTPException, Response
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
-from typing import List, Optional
-from datetime import date
-import openpyxl
-from openpyxl.styles import Font, Alignment
-from openpyxl.utils import get_column_letter
-
-# --- НАСТРОЙКА ---
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-app = FastAPI()
-
-# --- ФУНКЦИИ БАЗЫ ДАННЫХ ---
-def get_db_conn():
-    if not DATABASE_URL:
-        raise HTTPException(status_code=500, detail="DATABASE_URL не настроен на сервере!")
-    conn_str = DATABASE_URL
-    if 'sslmode' not in conn_str:
-        conn_str = f"{conn_str}?sslmode=require"
-    try:
-        conn = psycopg2.connect(conn_str)
-        return conn
-    except psycopg2.OperationalError as e:
-        raise RuntimeError(f"Критическая ошибка: не удалось подключиться к базе данных. Проверьте DATABASE_URL. Детали: {e}")
-
-def init_db():
-    print("Проверка и инициализация таблиц базы данных...")
-    try:
-        conn = get_db_conn()
-        with conn.cursor() as cursor:
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS cars (
-                id SERIAL PRIMARY KEY, user_id TEXT NOT NULL, name TEXT NOT NULL, plate TEXT,
-                current_mileage REAL DEFAULT 0, current_fuel REAL DEFAULT 0,
-                consumption_driving REAL DEFAULT 8.0, consumption_idle REAL DEFAULT 1.0,
-                is_active BOOLEAN DEFAULT true
-            )''')
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS fuel_logs (
-                id SERIAL PRIMARY KEY, car_id INTEGER NOT NULL REFERENCES cars(id) ON DELETE CASCADE,
-                date DATE NOT NULL, start_mileage REAL NOT NULL, end_mileage REAL NOT NULL,
-                trip_distance REAL NOT NULL, refueled REAL DEFAULT 0, idle_hours REAL DEFAULT 0,
-                fuel_consumed_driving REAL NOT NULL, fuel_consumed_idle REAL NOT NULL,
-                fuel_consumed_total REAL NOT NULL, fuel_after_trip REAL NOT NULL,
-                final_fuel_level REAL NOT NULL
-            )''')
-            conn.commit()
-        conn.close()
-        print("База данных готова к работе.")
-    except Exception as e:
-        print(f"!!! ОШИБКА ИНИЦИАЛИЗАЦИИ БАЗЫ ДАННЫХ: {e}")
-        raise e
-
-# --- СОБЫТИЕ ЗАПУСКА ПРИЛОЖЕНИЯ ---
-@app.on_event("startup")
-async def startup_event():
-    init_db()
-
-# --- Модели данных (Pydantic) ---
-class CarBase(BaseModel): name: str; plate: Optional[str] = None
-class CarCreate(CarBase): user_id: str
-class CarDetailsUpdate(CarBase): pass
-class CarUpdate(BaseModel): current_mileage: float; current_fuel: float; consumption_driving: float; consumption_idle: float
-class Car(CarBase): id: int; user_id: str; current_mileage: float; current_fuel: float; consumption_driving: float; consumption_idle: float; is_active: bool
-class LogCreate(BaseModel): car_id: int; user_id: str; date: date; start_mileage: float; end_mileage: float; refueled: float; idle_hours: float; consumption_driving: float; consumption_idle: float; start_fuel: float
-class LogEntryResponse(BaseModel): date: date; trip_distance: float; refueled: float; fuel_consumed_total: float; final_fuel_level: float
-class InitData(BaseModel): cars: List[Car]; active_car_id: Optional[int]
-
-# --- API эндпоинты (ПОЛНАЯ ВЕРСИЯ) ---
-@app.get("/api/init/{user_id}", response_model=InitData)
-def get_initial_data(user_id: str):
-    conn = get_db_conn()
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("SELECT * FROM cars WHERE user_id = %s", (user_id,))
-        cars = cursor.fetchall()
-        active_car = next((car for car in cars if car['is_active']), None)
-        active_car_id = active_car['id'] if active_car else None
-        if not active_car_id and cars:
-            active_car_id = cars[0]['id']
-            cursor.execute("UPDATE cars SET is_active = true WHERE id = %s", (active_car_id,))
-            conn.commit()
-    conn.close()
-    return {"cars": cars, "active_car_id": active_car_id}
-
-@app.post("/api/cars", response_model=Car)
-def add_car(car: CarCreate):
-    conn = get_db_conn()
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("UPDATE cars SET is_active = false WHERE user_id = %s", (car.user_id,))
-        cursor.execute(
-            "INSERT INTO cars (user_id, name, plate, is_active) VALUES (%s, %s, %s, true) RETURNING *",
-            (car.user_id, car.name, car.plate)
-        )
-        new_car = cursor.fetchone()
-        conn.commit()
-    conn.close()
-    return new_car
-
-@app.put("/api/cars/details/{car_id}", response_model=CarDetailsUpdate)
-def update_car_details(car_id: int, details: CarDetailsUpdate):
-    conn = get_db_conn()
-    with conn.cursor() as cursor:
-        cursor.execute("UPDATE cars SET name = %s, plate = %s WHERE id = %s", (details.name, details.plate, car_id))
-        conn.commit()
-    conn.close()
-    return details
-    
-@app.put("/api/cars/settings/{car_id}", response_model=CarUpdate)
-def update_car_settings(car_id: int, settings: CarUpdate):
-    conn = get_db_conn()
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("UPDATE cars SET current_mileage = %s, current_fuel = %s, consumption_driving = %s, consumption_idle = %s WHERE id = %s", (settings.current_mileage, settings.current_fuel, settings.consumption_driving, settings.consumption_idle, car_id))
-        conn.commit()
-    conn.close()
-    return settings
-
-@app.put("/api/cars/activate/{car_id}/{user_id}")
-def set_active_car(car_id: int, user_id: str):
-    conn = get_db_conn()
-    with conn.cursor() as cursor:
-        cursor.execute("UPDATE cars SET is_active = false WHERE user_id = %s", (user_id,))
-        cursor.execute("UPDATE cars SET is_active = true WHERE id = %s AND user_id = %s", (car_id, user_id))
-        conn.commit()
-    conn.close()
-    return {"message": "Active car updated"}
-
-@app.delete("/api/cars/{car_id}/{user_id}")
-def delete_car(car_id: int, user_id: str):
-    conn = get_db_conn()
-    with conn.cursor() as cursor:
-        cursor.execute("DELETE FROM cars WHERE id = %s AND user_id = %s", (car_id, user_id))
-        conn.commit()
-        cursor.execute("SELECT id FROM cars WHERE user_id = %s LIMIT 1", (user_id,))
-        remaining_car = cursor.fetchone()
-        if remaining_car:
-            cursor.execute("UPDATE cars SET is_active = true WHERE id = %s", (remaining_car[0],))
-            conn.commit()
-    conn.close()
-    return {"message": "Car deleted successfully"}
-
-@app.get("/api/logs/{car_id}", response_model=List[LogEntryResponse])
-def get_car_logs(car_id: int):
-    conn = get_db_conn()
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("SELECT date, trip_distance, refueled, fuel_consumed_total, final_fuel_level FROM fuel_logs WHERE car_id = %s ORDER BY date DESC, id DESC LIMIT 5", (car_id,))
-        logs = cursor.fetchall()
-    conn.close()
-    return logs
-
-@app.post("/api/logs")
-def calculate_and_log_trip(log: LogCreate):
-    trip_distance = log.end_mileage - log.start_mileage; fuel_consumed_driving = (trip_distance / 100) * log.consumption_driving; fuel_consumed_idle = log.idle_hours * log.consumption_idle; fuel_consumed_total = fuel_consumed_driving + fuel_consumed_idle; fuel_after_trip = log.start_fuel - fuel_consumed_total; final_fuel_level = fuel_after_trip + log.refueled
-    if final_fuel_level < 0: raise HTTPException(status_code=400, detail="Расчетный остаток топлива отрицательный.")
-    conn = get_db_conn()
-    with conn.cursor() as cursor:
-        cursor.execute("INSERT INTO fuel_logs (car_id, date, start_mileage, end_mileage, trip_distance, refueled, idle_hours, fuel_consumed_driving, fuel_consumed_idle, fuel_consumed_total, fuel_after_trip, final_fuel_level) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (log.car_id, log.date, log.start_mileage, log.end_mileage, trip_distance, log.refueled, log.idle_hours, fuel_consumed_driving, fuel_consumed_idle, fuel_consumed_total, fuel_after_trip, final_fuel_level));
-        cursor.execute("UPDATE cars SET current_mileage = %s, current_fuel = %s WHERE id = %s", (log.end_mileage, final_fuel_level, log.car_id));
-        conn.commit()
-    conn.close(); return {"new_mileage": log.end_mileage, "new_fuel_level": final_fuel_level}
-
-@app.get("/api/report")
-def generate_report(car_id: int, start_date: date, end_date: date):
-    conn = get_db_conn()
-    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-        cursor.execute("SELECT name, plate FROM cars WHERE id = %s", (car_id,)); car_info = cursor.fetchone()
-        if not car_info: raise HTTPException(status_code=404, detail="Car not found")
-        query = "SELECT date, start_mileage, end_mileage, trip_distance, refueled, idle_hours, fuel_consumed_total, final_fuel_level FROM fuel_logs WHERE car_id = %s AND date BETWEEN %s AND %s ORDER BY date ASC"; cursor.execute(query, (car_id, start_date, end_date)); logs = cursor.fetchall()
-    conn.close()
-    wb = openpyxl.Workbook(); ws = wb.active; ws.title = "Отчет по топливу"; ws.merge_cells('A1:H1'); title_cell = ws['A1']; title_cell.value = f"Отчет по автомобилю {car_info['name']} ({car_info['plate']}) за период с {start_date.strftime('%d.%m.%Y')} по {end_date.strftime('%d.%m.%Y')}"; title_cell.font = Font(bold=True, size=14); title_cell.alignment = Alignment(horizontal='center'); headers = ["Дата", "Пробег нач.", "Пробег кон.", "Пробег за поездку", "Заправлено, л", "Простой, ч", "Расход, л", "Остаток, л"]; ws.append(headers)
-    for cell in ws[2]: cell.font = Font(bold=True)
-    for log in logs: ws.append(list(log.values()))
-    for column_cells in ws.columns:
-        max_length = 0; column = get_column_letter(column_cells[0].column)
-        for cell in column_cells:
-            try:
-                if len(str(cell.value)) > max_length: max_length = len(str(cell.value))
-            except: pass
-        ws.column_dimensions[column].width = (max_length + 2)
-    from io import BytesIO; virtual_workbook = BytesIO(); wb.save(virtual_workbook); virtual_workbook.seek(0)
-    return Response(content=virtual_workbook.read(), media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers={"Content-Disposition": f"attachment; filename=report_{car_id}_{start_date}_to_{end_date}.xlsx"})
-
-app.mount("/", StaticFiles(directory=".", html=True), name="static")
-
-
-
-
-
-
+import os
+import re
+import time
+import hashlib
+import mimetypes
+import calendar
+import tempfile
+import contextlib
+import anyio
+import anyio.to_thread
+import asyncpg
+from cachetools import TTLCache
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Optional
+from datetime import date
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment
+from openpyxl.utils import get_column_letter
+
+# --- НАСТРОЙКА ---
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# --- MIDDLEWARE ---
+class FastCORSMiddleware:
+    """Чистый ASGI-middleware для CORS: без создания Request/Response на каждый запрос."""
+    _PREFLIGHT_HEADERS = [
+        (b"access-control-allow-origin", b"*"),
+        (b"access-control-allow-methods", b"GET,POST,PUT,DELETE,OPTIONS"),
+        (b"access-control-allow-headers", b"*"),
+        (b"access-control-max-age", b"600"),
+    ]
+
+    def __init__(self, app, allow_origin=b"*"):
+        self.app = app
+        self.allow_origin = allow_origin
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] == "OPTIONS":
+            # Preflight отвечаем сразу, не заходя в приложение
+            await send({"type": "http.response.start", "status": 204, "headers": self._PREFLIGHT_HEADERS})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"].append((b"access-control-allow-origin", self.allow_origin))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+class TimingMiddleware:
+    """Чистый ASGI-middleware: добавляет заголовок x-response-time без BaseHTTPMiddleware."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                ms = (time.perf_counter() - start) * 1000
+                message["headers"].append((b"x-response-time", f"{ms:.2f}ms".encode()))
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+# Отдельное под-приложение для API: короткая цепочка middleware, статика ходит мимо неё
+api_app = FastAPI(default_response_class=ORJSONResponse)
+api_app.add_middleware(FastCORSMiddleware)
+api_app.add_middleware(TimingMiddleware)
+# JSON-списки с повторяющимися ключами сжимаются в 3-5 раз; мелкие ответы не трогаем
+api_app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
+
+# --- ЖИЗНЕННЫЙ ЦИКЛ ПРИЛОЖЕНИЯ ---
+@contextlib.asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global POOL
+    if _conn_str:
+        # Пул asyncpg: TCP+TLS рукопожатие выполняется один раз, а не на каждый запрос,
+        # а ожидания базы переплетаются в одном event loop
+        # statement_cache_size: повторяющиеся запросы выполняются как prepared statements
+        # (сервер не парсит/не планирует SQL заново, по сети уходит только bind)
+        POOL = await asyncpg.create_pool(dsn=_conn_str, min_size=5, max_size=20, command_timeout=60, statement_cache_size=200)
+    await init_db()
+    _preload_static()
+    yield
+    # Корректное завершение: возвращаем соединения базе, не обрывая их
+    if POOL is not None:
+        await POOL.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# --- ФУНКЦИИ БАЗЫ ДАННЫХ ---
+POOL = None
+_conn_str = None
+if DATABASE_URL:
+    _conn_str = DATABASE_URL
+    if 'sslmode' not in _conn_str:
+        _conn_str = f"{_conn_str}?sslmode=require"
+
+@contextlib.asynccontextmanager
+async def get_db_conn():
+    if POOL is None:
+        raise HTTPException(status_code=500, detail="DATABASE_URL не настроен на сервере!")
+    # Ограниченное ожидание: при исчерпании пула запрос падает быстро, а не висит
+    async with POOL.acquire(timeout=2.0) as conn:
+        yield conn
+
+# FastAPI-зависимость: эндпоинты получают соединение из пула и гарантированно возвращают его
+async def db_dep():
+    async with get_db_conn() as conn:
+        yield conn
+
+async def init_db():
+    print("Проверка и инициализация таблиц базы данных...")
+    try:
+        async with get_db_conn() as conn:
+            await conn.execute('''
+            CREATE TABLE IF NOT EXISTS cars (
+                id SERIAL PRIMARY KEY, user_id TEXT NOT NULL, name TEXT NOT NULL, plate TEXT,
+                current_mileage REAL DEFAULT 0, current_fuel REAL DEFAULT 0,
+                consumption_driving REAL DEFAULT 8.0, consumption_idle REAL DEFAULT 1.0,
+                is_active BOOLEAN DEFAULT true
+            )''')
+            await conn.execute('''
+            CREATE TABLE IF NOT EXISTS fuel_logs (
+                id SERIAL PRIMARY KEY, car_id INTEGER NOT NULL REFERENCES cars(id) ON DELETE CASCADE,
+                date DATE NOT NULL, start_mileage REAL NOT NULL, end_mileage REAL NOT NULL,
+                trip_distance REAL NOT NULL, refueled REAL DEFAULT 0, idle_hours REAL DEFAULT 0,
+                fuel_consumed_driving REAL NOT NULL, fuel_consumed_idle REAL NOT NULL,
+                fuel_consumed_total REAL NOT NULL, fuel_after_trip REAL NOT NULL,
+                final_fuel_level REAL NOT NULL
+            )''')
+            # Инвариант остатка топлива живет в базе; добавление идемпотентно
+            with contextlib.suppress(asyncpg.DuplicateObjectError):
+                await conn.execute("ALTER TABLE fuel_logs ADD CONSTRAINT ck_fuel_logs_final_fuel_level CHECK (final_fuel_level >= 0)")
+            # Индексы под горячие запросы: покрывающий индекс отдает последние логи
+            # index-only сканом в порядке сортировки, без обращения к таблице
+            await conn.execute("DROP INDEX IF EXISTS ix_fuel_logs_car_date")
+            await conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_fuel_logs_car_date_id ON fuel_logs (car_id, date DESC, id DESC)
+                INCLUDE (trip_distance, refueled, fuel_consumed_total, final_fuel_level)''')
+            # (user_id, is_active) покрывает и выборку машин, и поиск активной
+            await conn.execute("DROP INDEX IF EXISTS ix_cars_user_id")
+            await conn.execute("CREATE INDEX IF NOT EXISTS ix_cars_user_active ON cars (user_id, is_active)")
+        print("База данных готова к работе.")
+    except Exception as e:
+        print(f"!!! ОШИБКА ИНИЦИАЛИЗАЦИИ БАЗЫ ДАННЫХ: {e}")
+        raise e
+
+# --- Модели данных (Pydantic) ---
+class CarBase(BaseModel): name: str; plate: Optional[str] = None
+class CarCreate(CarBase): user_id: str
+class CarDetailsUpdate(CarBase): pass
+class CarUpdate(BaseModel): current_mileage: float; current_fuel: float; consumption_driving: float; consumption_idle: float
+class Car(CarBase):
+    # Pydantic v2: валидация строк БД уходит в pydantic-core, лишние колонки не ломают ответ
+    model_config = ConfigDict(from_attributes=True, extra='ignore')
+    id: int; user_id: str; current_mileage: float; current_fuel: float; consumption_driving: float; consumption_idle: float; is_active: bool
+class LogCreate(BaseModel): car_id: int; user_id: str; date: date; start_mileage: float; end_mileage: float; refueled: float; idle_hours: float; consumption_driving: float; consumption_idle: float; start_fuel: float
+class LogEntryResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True, extra='ignore')
+    date: date; trip_distance: float; refueled: float; fuel_consumed_total: float; final_fuel_level: float
+class BulkLogCreate(BaseModel): logs: List[LogCreate]
+class InitData(BaseModel): cars: List[Car]; active_car_id: Optional[int]
+
+# --- SQL-константы: один и тот же объект строки на каждый вызов ---
+# Активная машина (если есть) оказывается первой, а если активной нет —
+# CTE назначает первую прямо в этом же запросе: один round trip в обоих случаях
+# Явный список колонок вместо SELECT *: будущие поля cars не раздувают ответ
+_CAR_COLUMNS = "id, user_id, name, plate, current_mileage, current_fuel, consumption_driving, consumption_idle, is_active"
+SQL_GET_CARS = (
+    f"WITH ranked AS (SELECT {_CAR_COLUMNS}, row_number() OVER (ORDER BY is_active DESC, id ASC) AS rn FROM cars WHERE user_id = $1), "
+    "fix AS (UPDATE cars SET is_active = true "
+    "WHERE id = (SELECT id FROM ranked WHERE rn = 1) AND NOT EXISTS (SELECT 1 FROM ranked WHERE is_active)) "
+    f"SELECT {_CAR_COLUMNS} FROM ranked ORDER BY rn"
+)
+SQL_ADD_CAR = (
+    "WITH deact AS (UPDATE cars SET is_active = false WHERE user_id = $1) "
+    f"INSERT INTO cars (user_id, name, plate, is_active) VALUES ($1, $2, $3, true) RETURNING {_CAR_COLUMNS}"
+)
+# RETURNING user_id: хозяин машины нужен для сброса INIT_CACHE без лишнего запроса
+SQL_UPDATE_CAR_DETAILS = "UPDATE cars SET name = $1, plate = $2 WHERE id = $3 RETURNING user_id"
+SQL_UPDATE_CAR_SETTINGS = "UPDATE cars SET current_mileage = $1, current_fuel = $2, consumption_driving = $3, consumption_idle = $4 WHERE id = $5 RETURNING user_id"
+SQL_SET_ACTIVE_CAR = "UPDATE cars SET is_active = (id = $1) WHERE user_id = $2"
+SQL_DELETE_CAR = (
+    "WITH d AS (DELETE FROM cars WHERE id = $1 AND user_id = $2) "
+    "UPDATE cars SET is_active = true WHERE id = (SELECT MIN(id) FROM cars WHERE user_id = $2 AND id <> $1)"
+)
+SQL_GET_LOGS = "SELECT date, trip_distance, refueled, fuel_consumed_total, final_fuel_level FROM fuel_logs WHERE car_id = $1 ORDER BY date DESC, id DESC LIMIT 5"
+# Арифметика поездки считается прямо в SQL из сырых входов ($1 car_id, $2 date,
+# $3 start_mileage, $4 end_mileage, $5 refueled, $6 idle_hours, $7 consumption_driving,
+# $8 consumption_idle, $9 start_fuel); отрицательный остаток режет CHECK-констрейнт,
+# и вся вставка атомарно откатывается
+SQL_INSERT_LOG_AND_UPDATE_CAR = (
+    "WITH calc AS (SELECT ($4::real - $3::real) AS trip_distance, "
+    "($4::real - $3::real) / 100.0 * $7::real AS fuel_driving, $6::real * $8::real AS fuel_idle), "
+    "calc2 AS (SELECT trip_distance, fuel_driving, fuel_idle, fuel_driving + fuel_idle AS fuel_total, "
+    "$9::real - (fuel_driving + fuel_idle) AS fuel_after FROM calc), "
+    "ins AS (INSERT INTO fuel_logs (car_id, date, start_mileage, end_mileage, trip_distance, refueled, idle_hours, fuel_consumed_driving, fuel_consumed_idle, fuel_consumed_total, fuel_after_trip, final_fuel_level) "
+    "SELECT $1::int, $2::date, $3::real, $4::real, trip_distance, $5::real, $6::real, fuel_driving, fuel_idle, fuel_total, fuel_after, fuel_after + $5::real "
+    "FROM calc2 RETURNING final_fuel_level) "
+    "UPDATE cars SET current_mileage = $4::real, current_fuel = ins.final_fuel_level "
+    "FROM ins WHERE cars.id = $1 RETURNING cars.user_id, ins.final_fuel_level"
+)
+SQL_INSERT_LOG = "INSERT INTO fuel_logs (car_id, date, start_mileage, end_mileage, trip_distance, refueled, idle_hours, fuel_consumed_driving, fuel_consumed_idle, fuel_consumed_total, fuel_after_trip, final_fuel_level) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)"
+SQL_UPDATE_CAR_FUEL = "UPDATE cars SET current_mileage = $1, current_fuel = $2 WHERE id = $3 RETURNING user_id"
+SQL_GET_CAR_INFO = "SELECT name, plate FROM cars WHERE id = $1"
+SQL_REPORT_FINGERPRINT = "SELECT COALESCE(MAX(id), 0) AS max_id, COUNT(*) AS cnt FROM fuel_logs WHERE car_id = $1 AND date BETWEEN $2 AND $3"
+SQL_REPORT_LOGS = "SELECT date, start_mileage, end_mileage, trip_distance, refueled, idle_hours, fuel_consumed_total, final_fuel_level FROM fuel_logs WHERE car_id = $1 AND date BETWEEN $2 AND $3 ORDER BY date ASC"
+
+# --- API эндпоинты (ПОЛНАЯ ВЕРСИЯ) ---
+
+# Формат месяца для /api/report; компилируется один раз на процесс
+_MONTH_RE = re.compile(r"^(\d{4})-(\d{2})$")
+
+# Кэш готовых xlsx-отчетов; актуальность проверяется по отпечатку (MAX(id), COUNT) логов
+REPORT_CACHE = TTLCache(maxsize=128, ttl=300)
+# Кэш готового ответа /init по user_id: частые открытия WebApp не ходят в БД;
+# любая запись, меняющая машины пользователя, сбрасывает его запись
+INIT_CACHE = TTLCache(maxsize=10_000, ttl=30)
+_REPORT_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Сборка workbook — чистый CPU: уводим её в отдельные потоки, не больше четырех сразу
+_REPORT_LIMITER = anyio.CapacityLimiter(4)
+
+def _evict_report_cache(car_id):
+    for key in [k for k in REPORT_CACHE if k[0] == car_id]:
+        REPORT_CACHE.pop(key, None)
+
+@api_app.get("/init/{user_id}", response_model=InitData)
+async def get_initial_data(user_id: str, request: Request, response: Response, conn=Depends(db_dep)):
+    cached = INIT_CACHE.get(user_id)
+    if cached is not None:
+        # Горячий путь: ответ собран недавно и машины не менялись — БД не нужна
+        etag, payload = cached
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "private, max-age=10"
+        return payload
+    cars = [dict(r) for r in await conn.fetch(SQL_GET_CARS, user_id)]
+    active_car_id = cars[0]['id'] if cars else None
+    if cars and not cars[0]['is_active']:
+        # CTE уже назначила первую машину активной — отражаем это в ответе
+        cars[0]['is_active'] = True
+    # ETag по содержимому списка машин: повторное открытие WebApp обходится 304-м без тела
+    etag = hashlib.blake2b(repr(cars).encode(), digest_size=8).hexdigest()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, max-age=10"
+    payload = {"cars": cars, "active_car_id": active_car_id}
+    INIT_CACHE[user_id] = (etag, payload)
+    return payload
+
+@api_app.post("/cars", response_model=Car)
+async def add_car(car: CarCreate, conn=Depends(db_dep)):
+    # CTE: деактивация старых машин и вставка новой за один round trip
+    new_car = await conn.fetchrow(SQL_ADD_CAR, car.user_id, car.name, car.plate)
+    INIT_CACHE.pop(car.user_id, None)
+    return dict(new_car)
+
+@api_app.put("/cars/details/{car_id}", response_model=CarDetailsUpdate)
+async def update_car_details(car_id: int, details: CarDetailsUpdate, conn=Depends(db_dep)):
+    owner = await conn.fetchrow(SQL_UPDATE_CAR_DETAILS, details.name, details.plate, car_id)
+    if owner: INIT_CACHE.pop(owner['user_id'], None)
+    return details
+    
+@api_app.put("/cars/settings/{car_id}", response_model=CarUpdate)
+async def update_car_settings(car_id: int, settings: CarUpdate, conn=Depends(db_dep)):
+    owner = await conn.fetchrow(SQL_UPDATE_CAR_SETTINGS, settings.current_mileage, settings.current_fuel, settings.consumption_driving, settings.consumption_idle, car_id)
+    if owner: INIT_CACHE.pop(owner['user_id'], None)
+    return settings
+
+@api_app.put("/cars/activate/{car_id}/{user_id}")
+async def set_active_car(car_id: int, user_id: str, conn=Depends(db_dep)):
+    # Одним UPDATE: выбранная машина получает true, остальные — false
+    await conn.execute(SQL_SET_ACTIVE_CAR, car_id, user_id)
+    INIT_CACHE.pop(user_id, None)
+    return {"message": "Active car updated"}
+
+@api_app.delete("/cars/{car_id}/{user_id}")
+async def delete_car(car_id: int, user_id: str, conn=Depends(db_dep)):
+    # Удаление и передача активности первой из оставшихся машин — один round trip
+    await conn.execute(SQL_DELETE_CAR, car_id, user_id)
+    INIT_CACHE.pop(user_id, None)
+    return {"message": "Car deleted successfully"}
+
+@api_app.get("/logs/{car_id}", response_model=List[LogEntryResponse])
+async def get_car_logs(car_id: int, request: Request, response: Response, conn=Depends(db_dep)):
+    logs = await conn.fetch(SQL_GET_LOGS, car_id)
+    # ETag по содержимому последних логов: при опросе без изменений уходит 304 без тела
+    etag = hashlib.blake2b(repr(logs).encode(), digest_size=8).hexdigest()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, max-age=10"
+    return [dict(log) for log in logs]
+
+@api_app.post("/logs")
+async def calculate_and_log_trip(log: LogCreate, conn=Depends(db_dep)):
+    # CTE: расчет производных величин, вставка лога и обновление машины — один round trip
+    try:
+        updated = await conn.fetchrow(
+            SQL_INSERT_LOG_AND_UPDATE_CAR,
+            log.car_id, log.date, log.start_mileage, log.end_mileage, log.refueled, log.idle_hours, log.consumption_driving, log.consumption_idle, log.start_fuel)
+    except asyncpg.ForeignKeyViolationError:
+        raise HTTPException(status_code=404, detail="Car not found")
+    except asyncpg.CheckViolationError:
+        # CHECK (final_fuel_level >= 0): база атомарно отвергла отрицательный остаток
+        raise HTTPException(status_code=400, detail="Расчетный остаток топлива отрицательный.")
+    if updated is None:
+        raise HTTPException(status_code=404, detail="Car not found")
+    _evict_report_cache(log.car_id)
+    # Поездка меняет пробег и остаток топлива — кэш /init владельца устарел
+    INIT_CACHE.pop(updated['user_id'], None)
+    return {"new_mileage": log.end_mileage, "new_fuel_level": updated['final_fuel_level']}
+
+@api_app.post("/logs/bulk")
+async def create_fuel_logs_bulk(bulk: BulkLogCreate, conn=Depends(db_dep)):
+    if not bulk.logs: raise HTTPException(status_code=400, detail="Пустой список поездок.")
+    rows = []; last_state = {}
+    for log in bulk.logs:
+        trip_distance = log.end_mileage - log.start_mileage; fuel_consumed_driving = (trip_distance / 100) * log.consumption_driving; fuel_consumed_idle = log.idle_hours * log.consumption_idle; fuel_consumed_total = fuel_consumed_driving + fuel_consumed_idle; fuel_after_trip = log.start_fuel - fuel_consumed_total; final_fuel_level = fuel_after_trip + log.refueled
+        if final_fuel_level < 0: raise HTTPException(status_code=400, detail="Расчетный остаток топлива отрицательный.")
+        rows.append((log.car_id, log.date, log.start_mileage, log.end_mileage, trip_distance, log.refueled, log.idle_hours, fuel_consumed_driving, fuel_consumed_idle, fuel_consumed_total, fuel_after_trip, final_fuel_level))
+        last_state[log.car_id] = (log.end_mileage, final_fuel_level)
+    async with conn.transaction():
+        # executemany отправляет все строки одним конвейером, а не по одной
+        await conn.executemany(SQL_INSERT_LOG, rows)
+        owners = set()
+        for car_id, (mileage, fuel) in last_state.items():
+            owner = await conn.fetchrow(SQL_UPDATE_CAR_FUEL, mileage, fuel, car_id)
+            if owner: owners.add(owner['user_id'])
+    for car_id in last_state:
+        _evict_report_cache(car_id)
+    for user_id in owners:
+        INIT_CACHE.pop(user_id, None)
+    return {"inserted": len(rows)}
+
+def _build_report_workbook(car_info, logs, start_date, end_date):
+    """Собирает xlsx-отчет и возвращает (буфер, размер). Выполняется в worker-потоке."""
+    headers = ["Дата", "Пробег нач.", "Пробег кон.", "Пробег за поездку", "Заправлено, л", "Простой, ч", "Расход, л", "Остаток, л"]
+    # Строки asyncpg — уже последовательности: отдаем их в ws.append без dict/атрибутов
+    rows = [tuple(log) for log in logs]
+    # Ширины колонок считаем по данным заранее: write-only лист нельзя перечитывать
+    widths = [len(h) for h in headers]
+    for row in rows:
+        for i, value in enumerate(row):
+            length = len(str(value))
+            if length > widths[i]: widths[i] = length
+    wb = openpyxl.Workbook(write_only=True); ws = wb.create_sheet("Отчет по топливу")
+    for i, width in enumerate(widths, 1): ws.column_dimensions[get_column_letter(i)].width = width + 2
+    title_cell = WriteOnlyCell(ws, value=f"Отчет по автомобилю {car_info['name']} ({car_info['plate']}) за период с {start_date.strftime('%d.%m.%Y')} по {end_date.strftime('%d.%m.%Y')}")
+    title_cell.font = Font(bold=True, size=14); title_cell.alignment = Alignment(horizontal='center')
+    ws.append([title_cell])
+    header_font = Font(bold=True)
+    header_cells = []
+    for h in headers:
+        cell = WriteOnlyCell(ws, value=h); cell.font = header_font; header_cells.append(cell)
+    ws.append(header_cells)
+    for row in rows: ws.append(row)
+    # Spool: маленькие отчеты остаются в RAM, большие уходят на диск; ответ отдается чанками
+    buf = tempfile.SpooledTemporaryFile(max_size=8_000_000)
+    wb.save(buf)
+    size = buf.tell(); buf.seek(0)
+    return buf, size
+
+@api_app.get("/report")
+async def generate_report(request: Request, car_id: int, start_date: Optional[date] = None, end_date: Optional[date] = None, month: Optional[str] = None, conn=Depends(db_dep)):
+    if month:
+        # Отчет за месяц: последний день берем из calendar.monthrange, без арифметики timedelta
+        m = _MONTH_RE.match(month)
+        if not m:
+            raise HTTPException(status_code=400, detail="Неверный формат месяца, ожидается YYYY-MM.")
+        year, month_num = int(m.group(1)), int(m.group(2))
+        if not 1 <= month_num <= 12:
+            raise HTTPException(status_code=400, detail="Неверный формат месяца, ожидается YYYY-MM.")
+        start_date = date(year, month_num, 1)
+        end_date = date(year, month_num, calendar.monthrange(year, month_num)[1])
+    if not start_date or not end_date:
+        raise HTTPException(status_code=400, detail="Укажите start_date и end_date или month.")
+    # READ ONLY транзакция: все три запроса видят один снимок, без блокировок на запись
+    async with conn.transaction(readonly=True):
+        car_info = await conn.fetchrow(SQL_GET_CAR_INFO, car_id)
+        if not car_info: raise HTTPException(status_code=404, detail="Car not found")
+        # Дешевый отпечаток периода (index-only скан): решает, можно ли отдать кэш или 304
+        fp = await conn.fetchrow(SQL_REPORT_FINGERPRINT, car_id, start_date, end_date)
+        etag = f'"{car_id}-{start_date}-{end_date}-{fp["max_id"]}-{fp["cnt"]}"'
+        # xlsx уже сжат (zip): Content-Encoding: identity выводит его из-под GZipMiddleware
+        report_headers = {"Content-Disposition": f"attachment; filename=report_{car_id}_{start_date}_to_{end_date}.xlsx", "ETag": etag, "Content-Encoding": "identity"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304)
+        cache_key = (car_id, start_date, end_date)
+        cached = REPORT_CACHE.get(cache_key)
+        if cached is not None and cached[0] == etag:
+            return Response(content=cached[1], media_type=_REPORT_MEDIA_TYPE, headers=report_headers)
+        logs = await conn.fetch(SQL_REPORT_LOGS, car_id, start_date, end_date)
+    # Сборка xlsx — синхронный CPU-код: выносим в поток, чтобы не блокировать event loop
+    buf, size = await anyio.to_thread.run_sync(_build_report_workbook, car_info, logs, start_date, end_date, limiter=_REPORT_LIMITER)
+    if size <= 1_000_000:
+        # Небольшие отчеты кэшируем целиком: повторная выгрузка — memcpy вместо сборки workbook
+        data = buf.read()
+        REPORT_CACHE[cache_key] = (etag, data)
+        return Response(content=data, media_type=_REPORT_MEDIA_TYPE, headers=report_headers)
+    return StreamingResponse(buf, media_type=_REPORT_MEDIA_TYPE, headers=report_headers)
+
+# --- Статика SPA ---
+# Набор ассетов мал и не меняется за время жизни процесса: читаем их в память на старте
+# и отдаем без os.stat и чтения с диска, с ETag/304 на повторные открытия WebApp
+_STATIC_EXTENSIONS = (".html", ".css", ".js", ".png", ".svg", ".ico")
+STATIC_CACHE = {}
+_static_fallback = StaticFiles(directory=".", html=True)
+
+def _preload_static():
+    for name in os.listdir("."):
+        if name.endswith(_STATIC_EXTENSIONS) and os.path.isfile(name):
+            with open(name, "rb") as f: body = f.read()
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            STATIC_CACHE[name] = (body, etag, mimetypes.guess_type(name)[0] or "application/octet-stream")
+
+async def serve_static(request: Request, path: str):
+    entry = STATIC_CACHE.get(path or "index.html")
+    if entry is None:
+        # Путь вне предзагруженного набора — обычная отдача с диска
+        return await _static_fallback.get_response(path or ".", request.scope)
+    body, etag, media_type = entry
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+    return Response(content=body, media_type=media_type, headers={"ETag": etag, "Cache-Control": "public, max-age=3600"})
+
+# Порядок регистрации важен: /api должен матчиться раньше catch-all статики
+app.mount("/api", api_app)
+app.add_api_route("/{path:path}", serve_static, methods=["GET"], include_in_schema=False)
+app.mount("/", _static_fallback, name="static")
+
+if __name__ == "__main__":
+    import uvicorn
+    # uvloop + httptools: Cython-реализации event loop и HTTP-парсера
+    uvicorn.run("main:app", host="0.0.0.0", port=int(os.getenv("PORT", "8000")), loop="uvloop", http="httptools")
+
+
+
+
+
+
@@ -2,10 +2,7 @@
 set -e # Выходить из скрипта при любой ошибке
 
 echo "--- Запуск веб-сервера ---"
-uvicorn main:app --host 0.0.0.0 --port $PORT &
-
-echo "--- Ожидание 3 секунды для инициализации сервера ---"
-sleep 3
+uvicorn main:app --host 0.0.0.0 --port $PORT --loop uvloop --http httptools --backlog 2048 &
 
 echo "--- Запуск телеграм-бота ---"
 python bot.py